@@ -11,3 +11,6 @@ FULL_NAME_PREFIX = "full"
 
 # Prefix for subset analysis files
 SUBSET_NAME_PREFIX = "size"
+
+# Prefix for cached bootstrap parquet files
+BOOTSTRAP_CACHE_PREFIX = ".bootstraps"
@@ -1,13 +1,37 @@
 # rescreener.analysis
 
+import contextlib
+import hashlib
 import os
-from glob import glob
-from typing import Optional
+import re
+import tempfile
+from functools import cached_property
+from glob import escape, glob
+from typing import List, Optional, TypeVar
 
+import numpy as np
 import polars as pl
-from tqdm import tqdm
 
-from ._constants import FULL_DIR, FULL_NAME_PREFIX, SUBSET_DIR
+from ._constants import (
+    BOOTSTRAP_CACHE_PREFIX,
+    FULL_DIR,
+    FULL_NAME_PREFIX,
+    SUBSET_DIR,
+)
+
+_FrameType = TypeVar("_FrameType", pl.DataFrame, pl.LazyFrame)
+
+# Columns (and their types) read from hit files - everything else is never used
+_HITS_SCHEMA = {"gene": pl.String, "fdr": pl.Float32}
+
+# Part of the bootstrap cache key - bump whenever the schema, dtypes, or sort order
+# of the loaded bootstraps change so caches written by older loaders are not reused
+_BOOTSTRAP_CACHE_VERSION = 1
+
+# Captures the cohort name, subset size, and replicate index from a subset result path
+_SUBSET_NAME_PATTERN = re.compile(
+    r"(?P<cohort>[^/\\]+?_(?P<subset>\d+)_(?P<replicate>\d+))\.gene_results\.tsv$"
+)
 
 
 class BootstrapAnalysis:
@@ -24,6 +48,7 @@ class BootstrapAnalysis:
         standard: Optional[str] = None,
         fdr: float = 0.1,
         ignore_amalgams: bool = True,
+        cache: bool = True,
     ):
         """
         Initialize the BootstrapAnalysis object.
@@ -33,27 +58,43 @@ class BootstrapAnalysis:
             standard (Optional[str], optional): Path to a file containing standard hits. Defaults to None.
             fdr (float, optional): False Discovery Rate threshold for considering hits. Defaults to 0.1.
             ignore_amalgams (bool, optional): Whether to ignore amalgamated hits. Defaults to True.
+            cache (bool, optional): Whether to cache the loaded bootstraps as parquet in the subset directory. Defaults to True.
         """
         (self.directory, self.full_dir, self.subset_dir) = self._validate_directory(
             directory
         )
         self.fdr = fdr
         self.ignore_amalgams = ignore_amalgams
+        self.cache = cache
 
-        # Read the standard (either a secondary provided hits file or generated from the full directory)
-        self.standard = self._load_standard(standard)
+        # Share categorical encodings of `gene`/`cohort` across all loaded frames
+        with pl.StringCache():
+            # Read the standard (either a secondary provided hits file or generated from the full directory)
+            self.standard = self._load_standard(standard)
 
-        # Read in all the bootstraps
-        self.bootstraps = self._load_bootstraps()
+            # Read in all the bootstraps
+            self.bootstraps = self._load_bootstraps()
 
-        # Measure overlap between groups
-        self.overlaps = self._measure_overlap()
+            # Restrict the bootstraps to genes in the standard once
+            self._standard_genes = self.standard.select(pl.col("gene").unique())
+            self._bootstraps_hits = self.bootstraps.join(
+                self._standard_genes, on="gene", how="semi"
+            )
 
-        # Measures standard gene representation in bootstraps
-        self.recovery = self._measure_hit_recovery()
+            # Precompute the set sizes and cohort totals shared by the measurements
+            self._in_set = self._standard_genes.to_series()
+            self.total_tests = self.bootstraps.select("cohort").n_unique()
+            self._hit_totals = self._bootstraps_hits.select("cohort").n_unique()
+            self._subset_totals = dict(
+                self._bootstraps_hits.group_by("subset")
+                .agg(pl.col("cohort").n_unique())
+                .iter_rows()
+            )
 
-        # Measures standard gene representation in boostraps of a specific size
-        self.subset_recovery = self._measure_subset_recovery()
+            # Plan the measurements - each is collected on first access
+            self._overlaps_plan = self._measure_overlap()
+            self._recovery_plan = self._measure_hit_recovery()
+            self._subset_recovery_plan = self._measure_subset_recovery()
 
         print("Analysis loaded.")
 
@@ -73,11 +114,14 @@ class BootstrapAnalysis:
         directory = os.path.abspath(directory)
         full_dir = os.path.join(directory, FULL_DIR)
         subset_dir = os.path.join(directory, SUBSET_DIR)
-        if not os.path.exists(directory):
+        try:
+            with os.scandir(directory) as it:
+                subdirs = {e.name for e in it if e.is_dir()}
+        except (FileNotFoundError, NotADirectoryError):
             raise ValueError(f"The directory {directory} does not exist")
-        if not os.path.exists(full_dir):
+        if FULL_DIR not in subdirs:
             raise ValueError(f"The expected directory {full_dir} does not exist")
-        if not os.path.exists(subset_dir):
+        if SUBSET_DIR not in subdirs:
             raise ValueError(f"The expected directory {subset_dir} does not exist")
         return (
             directory,
@@ -104,97 +148,253 @@ class BootstrapAnalysis:
 
         return BootstrapAnalysis._load_hits_dataframe(
             filename, self.fdr, self.ignore_amalgams
-        )
+        ).with_columns(pl.col("gene").cast(pl.Categorical))
 
     def _load_bootstraps(self) -> pl.DataFrame:
         """
         Load all bootstrap results from the subset directory.
 
+        If caching is enabled the concatenated frame is written to a parquet file
+        in the subset directory and reused while the inputs and parameters match.
+
         Returns:
             pl.DataFrame: Concatenated DataFrame of all bootstrap results.
         """
-        hit_files = glob(
-            os.path.join(
-                self.subset_dir,
-                "*.gene_results.tsv",
-            )
-        )
-        cohort_names = [
-            os.path.basename(x).split(".gene_results")[0] for x in hit_files
-        ]
-        iterable = tqdm(
-            zip(hit_files, cohort_names),
-            desc="Loading hits from subsets",
-            total=len(hit_files),
-        )
-        return pl.concat(
+        hit_files = glob(os.path.join(self.subset_dir, "*.gene_results.tsv"))
+        cache_path = None
+        if self.cache:
+            cache_path = self._bootstrap_cache_path(hit_files)
+        if cache_path is not None and os.path.exists(cache_path):
+            return pl.read_parquet(cache_path)
+
+        # Read the filtered hit files in parallel, then attach the cohort metadata
+        # parsed once per file by repeating its row once per hit in that file
+        frames = pl.collect_all(
             [
-                BootstrapAnalysis._load_hits_dataframe(path, self.fdr).with_columns(
-                    pl.lit(name).alias("cohort"),
-                    pl.lit(int(name.split("_")[-1])).alias("replicate"),
-                    pl.lit(int(name.split("_")[-2])).alias("subset"),
+                BootstrapAnalysis._filter_hits(
+                    pl.scan_csv(
+                        path,
+                        separator="\t",
+                        schema_overrides=_HITS_SCHEMA,
+                        low_memory=False,
+                        rechunk=False,
+                    ).select(*_HITS_SCHEMA),
+                    self.fdr,
+                    self.ignore_amalgams,
                 )
-                for path, name in iterable
-            ]
+                for path in hit_files
+            ],
+            streaming=True,
+        )
+        names = [_SUBSET_NAME_PATTERN.search(path) for path in hit_files]
+        metadata = pl.DataFrame(
+            {
+                "cohort": [name["cohort"] for name in names],
+                "replicate": [int(name["replicate"]) for name in names],
+                "subset": [int(name["subset"]) for name in names],
+            },
+            schema={
+                "cohort": pl.Categorical,
+                "replicate": pl.Int32,
+                "subset": pl.Int32,
+            },
         )
+        rows = np.repeat(np.arange(len(frames)), [frame.height for frame in frames])
+        bootstraps = (
+            pl.concat(
+                [pl.concat(frames, rechunk=False), metadata[rows]], how="horizontal"
+            )
+            .lazy()
+            .with_columns(pl.col("gene").cast(pl.Categorical))
+            .unique(subset=["cohort", "gene"], maintain_order=False)
+            # Keep group keys contiguous for the downstream group-bys
+            .sort(["subset", "cohort", "gene"])
+            .collect(streaming=True)
+        )
+        if cache_path is not None:
+            self._write_bootstrap_cache(bootstraps, cache_path)
+        return bootstraps
 
-    def _measure_overlap(self) -> pl.DataFrame:
+    def _write_bootstrap_cache(self, bootstraps: pl.DataFrame, cache_path: str):
         """
-        Calculate the overlap between the standard and each bootstrap.
+        Atomically write the bootstraps parquet cache.
+
+        The frame is written to a temporary file in the subset directory and moved
+        into place, so an interrupted write never leaves a truncated cache behind.
+        Once it is in place, caches for other inputs or parameters and temporary
+        files left by killed writers are removed. Caching is skipped if the subset
+        directory is not writable.
+
+        Args:
+            bootstraps (pl.DataFrame): Loaded bootstrap results.
+            cache_path (str): Final path of the cache file.
+        """
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=f"{BOOTSTRAP_CACHE_PREFIX}_", suffix=".tmp", dir=self.subset_dir
+            )
+        except OSError:
+            return
+        os.close(fd)
+        try:
+            bootstraps.write_parquet(tmp_path, compression="zstd", compression_level=3)
+            os.replace(tmp_path, cache_path)
+        except BaseException as err:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            if not isinstance(err, OSError):
+                raise
+            return
+
+        pattern = os.path.join(escape(self.subset_dir), f"{BOOTSTRAP_CACHE_PREFIX}_*")
+        for path in glob(pattern):
+            if path != cache_path and path.endswith((".parquet", ".tmp")):
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+
+    def _bootstrap_cache_path(self, hit_files: List[str]) -> Optional[str]:
+        """
+        Build the parquet cache path for the bootstraps in the subset directory.
+
+        The cache key covers the loader version and the filtering parameters along
+        with the number and latest modification time of the hit files.
+
+        Args:
+            hit_files (List[str]): Paths to the bootstrap hit files.
 
         Returns:
-            pl.DataFrame: DataFrame containing overlap information for each bootstrap.
+            Optional[str]: Path to the cache file, or None if there are no hit files.
+        """
+        if len(hit_files) == 0:
+            return None
+        mtime = max(os.path.getmtime(f) for f in hit_files)
+        fields = (
+            _BOOTSTRAP_CACHE_VERSION,
+            self.fdr,
+            self.ignore_amalgams,
+            mtime,
+            len(hit_files),
+        )
+        key = hashlib.blake2b("|".join(map(str, fields)).encode()).hexdigest()[:16]
+        return os.path.join(self.subset_dir, f"{BOOTSTRAP_CACHE_PREFIX}_{key}.parquet")
+
+    @cached_property
+    def overlaps(self) -> pl.DataFrame:
+        """
+        Overlap between the standard and each bootstrap.
         """
         print("Measuring set overlaps...")
-        in_set = self.standard.select("gene").to_series().unique()
+        return self._overlaps_plan.collect(streaming=True)
+
+    @cached_property
+    def overlap_medians(self) -> pl.DataFrame:
+        """
+        Median overlap per subset size (used to link violins in plots).
+        """
         return (
-            self.bootstraps.group_by(["cohort", "replicate", "subset"])
-            .agg(pl.col("gene").is_in(in_set).sum().alias("num_overlapping"))
+            self.overlaps.group_by("subset")
+            .agg(pl.col("frac_overlapping").median())
+            .sort("subset")
+        )
+
+    @cached_property
+    def recovery(self) -> pl.DataFrame:
+        """
+        Standard gene representation in bootstraps.
+        """
+        print("Measuring hit recovery...")
+        return self._recovery_plan.collect()
+
+    @cached_property
+    def subset_recovery(self) -> pl.DataFrame:
+        """
+        Standard gene representation in bootstraps of a specific size.
+        """
+        print("Measuring subset recovery...")
+        return self._subset_recovery_plan.collect()
+
+    def _measure_overlap(self) -> pl.LazyFrame:
+        """
+        Plan the overlap calculation between the standard and each bootstrap.
+
+        Returns:
+            pl.LazyFrame: Plan producing overlap information for each bootstrap.
+        """
+        # `_in_set` shares the categorical encoding of `gene` so `is_in` compares codes
+        if self._in_set.len() > 0:
+            overlap = pl.col("gene").is_in(self._in_set).sum()
+        else:
+            overlap = pl.lit(0, dtype=pl.UInt32)
+        return (
+            self.bootstraps.lazy()
+            .group_by(["cohort", "replicate", "subset"])
+            .agg(overlap.alias("num_overlapping"))
             .with_columns(
-                (pl.col("num_overlapping") / in_set.len()).alias("frac_overlapping")
+                (pl.col("num_overlapping") / self._in_set.len()).alias(
+                    "frac_overlapping"
+                )
             )
             .sort(["subset", "replicate"])
+            # The categorical encoding is internal - tables expose plain strings
+            .with_columns(pl.col("cohort").cast(pl.String))
         )
 
-    def _measure_hit_recovery(self, cohort_size: Optional[int] = None) -> pl.DataFrame:
+    def _measure_hit_recovery(self, cohort_size: Optional[int] = None) -> pl.LazyFrame:
         """
-        Calculate how often a hit in the standard is observed across all bootstraps.
+        Plan how often a hit in the standard is observed across all bootstraps.
 
         Returns:
-            pl.DataFrame: DataFrame containing hit recovery information for each gene.
+            pl.LazyFrame: Plan producing hit recovery information for each gene.
         """
-        if cohort_size is None:
-            print("Measuring hit recovery...")
-        in_set = self.standard.select("gene").to_series().unique()
-        self.total_tests = self.bootstraps.select("cohort").n_unique()
-
-        subset = self.bootstraps.filter(pl.col("gene").is_in(in_set))
+        subset = self._bootstraps_hits.lazy()
+        total_tests = self._hit_totals
         if cohort_size is not None:
             subset = subset.filter(pl.col("subset") == cohort_size)
-        total_tests = subset.select("cohort").n_unique()
+            total_tests = self._subset_totals.get(cohort_size, 0)
+        return BootstrapAnalysis._recovery_from_hits(subset, total_tests)
+
+    @staticmethod
+    def _recovery_from_hits(subset: pl.LazyFrame, total_tests: int) -> pl.LazyFrame:
+        """
+        Plan per-gene recovery from bootstraps restricted to standard genes.
+
+        Args:
+            subset (pl.LazyFrame): Bootstrap hits restricted to genes in the standard.
+            total_tests (int): Number of bootstraps in the subset with any standard hit.
+
+        Returns:
+            pl.LazyFrame: Plan producing hit recovery information for each gene.
+        """
         return (
             subset.group_by("gene")
-            .agg(pl.col("cohort").len().alias("num_tests"))
+            .agg(pl.len().alias("num_tests"))
             .with_columns((pl.col("num_tests") / total_tests).alias("frac_tests"))
             .sort("frac_tests")
+            .with_columns(pl.col("gene").cast(pl.String))
         )
 
-    def _measure_subset_recovery(self) -> pl.DataFrame:
+    def _measure_subset_recovery(self) -> pl.LazyFrame:
         """
-        Calculate how often a hit in the standard is observed across all bootstraps of a specific size.
+        Plan how often a hit in the standard is observed across all bootstraps of a specific size.
 
         Returns:
-            pl.DataFrame: DataFrame containing hit recovery information for each gene in each subset size.
+            pl.LazyFrame: Plan producing hit recovery information for each gene in each subset size.
         """
-        print("Measuring subset recovery...")
-        cohort_sizes = self.bootstraps.select("subset").to_series().unique()
-        return pl.concat(
-            [
-                self._measure_hit_recovery(cohort_size).with_columns(
-                    pl.lit(cohort_size).alias("subset")
-                )
-                for cohort_size in cohort_sizes
-            ]
+        total_tests = pl.col("subset").replace_strict(
+            self._subset_totals, return_dtype=pl.UInt32
+        )
+        return (
+            self._bootstraps_hits.lazy()
+            .group_by(["subset", "gene"])
+            .agg(pl.len().alias("num_tests"))
+            .select(
+                "gene",
+                "num_tests",
+                (pl.col("num_tests") / total_tests).alias("frac_tests"),
+                "subset",
+            )
+            .sort(["subset", "frac_tests"])
+            .with_columns(pl.col("gene").cast(pl.String))
         )
 
     def export_table(self, table: str, filename: str, separator="\t", **kwargs):
@@ -221,6 +421,7 @@ class BootstrapAnalysis:
         filename: str,
         fdr: float,
         ignore_amalgams: bool = True,
+        columns: Optional[List[str]] = None,
     ) -> pl.DataFrame:
         """
         Load a hits dataframe from a file and filter based on FDR.
@@ -228,11 +429,39 @@ class BootstrapAnalysis:
         Args:
             filename (str): Path to the file containing hit data.
             fdr (float): False Discovery Rate threshold for filtering hits.
+            ignore_amalgams (bool, optional): Whether to drop amalgamated hits. Defaults to True.
+            columns (Optional[List[str]], optional): Columns to read. Defaults to `gene` and `fdr`.
 
         Returns:
             pl.DataFrame: Filtered DataFrame containing hits.
         """
-        frame = pl.read_csv(filename, separator="\t").filter(pl.col("fdr") < fdr)
+        frame = pl.read_csv(
+            filename,
+            separator="\t",
+            columns=columns if columns is not None else list(_HITS_SCHEMA),
+            schema_overrides=_HITS_SCHEMA,
+        )
+        return BootstrapAnalysis._filter_hits(frame, fdr, ignore_amalgams)
+
+    @staticmethod
+    def _filter_hits(
+        frame: _FrameType,
+        fdr: float,
+        ignore_amalgams: bool = True,
+    ) -> _FrameType:
+        """
+        Filter a hits frame (eager or lazy) based on FDR and amalgam status.
+
+        Args:
+            frame (_FrameType): DataFrame or LazyFrame containing hit data.
+            fdr (float): False Discovery Rate threshold for filtering hits.
+            ignore_amalgams (bool, optional): Whether to drop amalgamated hits. Defaults to True.
+
+        Returns:
+            _FrameType: Filtered frame of the same type as the input.
+        """
+        # Compare in the column's Float32 so the filter never upcasts `fdr`
+        frame = frame.filter(pl.col("fdr") < pl.lit(fdr, dtype=_HITS_SCHEMA["fdr"]))
         if ignore_amalgams:
             frame = frame.filter(~pl.col("gene").str.starts_with("amalgam"))
         return frame
@@ -1,7 +1,9 @@
 # rescreener.plotting
 
+import os
 from typing import TYPE_CHECKING, Optional, Tuple
 
+import matplotlib
 import matplotlib.pyplot as plt
 import polars as pl
 import seaborn as sns
@@ -10,6 +12,10 @@ from matplotlib.font_manager import FontProperties
 if TYPE_CHECKING:
     from .analysis import BootstrapAnalysis
 
+# Render headless when plots are only ever saved
+if os.environ.get("RESCREENER_NOSHOW"):
+    matplotlib.use("Agg")
+
 
 class BootstrapPlot:
     """
@@ -67,12 +73,29 @@ class BootstrapPlot:
 
         self.grid_kwargs = {}
 
-    def plot_extra(self):
+        # Figure and axes reused across calls to `plot`
+        self._fig = None
+        self._ax = None
+
+    def _get_axes(self) -> plt.Axes:
+        """
+        Return a cleared axes to draw on, creating the figure only when needed.
+
+        The figure is recreated if it was closed (e.g. by an inline backend).
+        """
+        if self._fig is None or not plt.fignum_exists(self._fig.number):
+            self._fig, self._ax = plt.subplots(**self.plt_kwargs, layout="constrained")
+        else:
+            self._ax.cla()
+            plt.figure(self._fig.number)
+        return self._ax
+
+    def plot_extra(self, ax: Optional[plt.Axes] = None):
         """
         Plots an extra layer on the plot if the attribute is set
         """
         if self.extra is not None:
-            self.extra(**self.extra_kwargs)
+            self.extra(**self.extra_kwargs, ax=ax)
 
     def plot(
         self,
@@ -87,26 +110,26 @@ class BootstrapPlot:
             save (Optional[str], optional): File path to save the plot. Defaults to None.
         """
 
-        plt.figure(**self.plt_kwargs)
         # Set font to Arial and font size to 6
         plt.rcParams["font.family"] = self.font_family
         plt.rcParams["font.size"] = self.font_size
+        ax = self._get_axes()
 
         self.seaborn(
             **self.sns_kwargs,
+            ax=ax,
         )
         if len(self.grid_kwargs) > 0:
-            plt.grid(**self.grid_kwargs)
+            ax.grid(**self.grid_kwargs)
 
-        plt.xlabel(self.xlabel)
-        plt.ylabel(self.ylabel)
-        plt.title(self.title)
+        ax.set_xlabel(self.xlabel)
+        ax.set_ylabel(self.ylabel)
+        ax.set_title(self.title)
 
         if self.xtick_rotation:
-            plt.xticks(rotation=90)
+            ax.tick_params(axis="x", labelrotation=90)
 
         if self.italicize_genes:
-            ax = plt.gca()
             fontstyle = FontProperties()
             fontstyle.set_style("italic")
 
@@ -122,14 +145,12 @@ class BootstrapPlot:
             ax.set_xticklabels(labels, fontproperties=fontstyle)
 
         if self.ylim is not None:
-            plt.ylim(self.ylim)
-
-        self.plot_extra()
+            ax.set_ylim(self.ylim)
 
-        plt.tight_layout()
+        self.plot_extra(ax)
 
         if save is not None:
-            plt.savefig(save)
+            self._fig.savefig(save)
         if show:
             plt.show()
 
@@ -155,6 +176,7 @@ class Violins(BootstrapPlot):
         fill: bool = False,
         ylim: Tuple[float, float] = (0, 1),
         draw_median_list: bool = True,
+        kde_sample: Optional[int] = 15000,
         inner_kwargs: dict = {},
         grid_kwargs: dict = {},
         sns_kwargs: dict = {},
@@ -175,6 +197,7 @@ class Violins(BootstrapPlot):
             linestyle (str, optional): Style of the violin plot outline. Defaults to "-".
             fill (bool, optional): Whether to fill the violin plot. Defaults to False.
             draw_median_list (bool): Whether to draw a pointplot to link the medians. Defaults to True.
+            kde_sample (Optional[int], optional): Maximum number of bootstraps per subset size used to fit each violin. Defaults to 15000.
             inner_kwargs (dict, optional): Additional kwargs for inner plot elements. Defaults to {}.
             grid_kwargs (dict, optional): Additional kwargs for grid. Defaults to {}.
             sns_kwargs (dict, optional): Additional kwargs for seaborn plot. Defaults to {}.
@@ -193,8 +216,17 @@ class Violins(BootstrapPlot):
         )
         self.sns_inner_kwargs.update(inner_kwargs)
 
+        # Cap the points per violin - the KDE gains nothing visible past this
+        data = bsa.overlaps.select(
+            "subset", pl.col("frac_overlapping").cast(pl.Float32)
+        )
+        if kde_sample is not None:
+            data = data.filter(
+                pl.int_range(pl.len()).shuffle(seed=0).over("subset") < kde_sample
+            )
+
         self.sns_kwargs = dict(
-            data=bsa.overlaps,
+            data=data,
             x="subset",
             y="frac_overlapping",
             color=color,
@@ -203,15 +235,15 @@ class Violins(BootstrapPlot):
             alpha=alpha,
             linestyle=linestyle,
             fill=fill,
-            **sns_kwargs,
+            # Keep violin bodies as raster in vector outputs (axes and text stay vector)
+            rasterized=True,
         )
+        self.sns_kwargs.update(sns_kwargs)
 
         if draw_median_list:
             self.extra = sns.pointplot
             self.extra_kwargs = dict(
-                data=bsa.overlaps.group_by("subset").agg(
-                    pl.col("frac_overlapping").median()
-                ),
+                data=bsa.overlap_medians.cast({"frac_overlapping": pl.Float32}),
                 x="subset",
                 y="frac_overlapping",
                 color="darkred",
@@ -269,16 +301,27 @@ class Recovery(BootstrapPlot):
 
         if relabel_tss:
             bsa.recovery = bsa.recovery.with_columns(
-                pl.col("gene").str.replace("_P1", "").str.replace("_P2", "")
+                pl.col("gene")
+                .cast(pl.String)
+                .str.replace("_P1", "")
+                .str.replace("_P2", "")
             )
 
+        # Only the plotted genes reach seaborn, not every category in the string cache
+        data = bsa.recovery.select(
+            pl.col("gene").cast(pl.String), pl.col("frac_tests").cast(pl.Float32)
+        )
+
+        # Each bar is a single value unless TSS variants are merged, so skip the
+        # bootstrapped confidence intervals by default
         self.seaborn = sns.barplot
         self.sns_kwargs = dict(
-            data=bsa.recovery,
+            data=data,
             x="gene",
             y="frac_tests",
             color=color,
-            **sns_kwargs,
+            errorbar=None,
         )
+        self.sns_kwargs.update(sns_kwargs)
         self.xtick_rotation = True
         self.italicize_genes = italicize_genes
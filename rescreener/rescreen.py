@@ -1,18 +1,64 @@
 # rescreener.rescreen
 
-import multiprocessing
+import functools
+import gzip
 import os
+import re
 import shutil
-from subprocess import PIPE, Popen
-from typing import List, Optional, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from glob import escape, glob
+from subprocess import DEVNULL, PIPE, Popen
+from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
-import pandas as pd
 from tqdm.auto import tqdm
 
 from ._constants import FULL_DIR, FULL_NAME_PREFIX, SUBSET_DIR, SUBSET_NAME_PREFIX
 
 
+@functools.lru_cache(maxsize=1)
+def _resolve_crispr_screen() -> Optional[str]:
+    """
+    Resolve the absolute path of `crispr_screen` in the system PATH once per process.
+
+    Returns:
+        Optional[str]: Absolute path to `crispr_screen`, or None if it is not found.
+    """
+    return shutil.which("crispr_screen")
+
+
+def _remove_trees(paths: List[str]):
+    """
+    Remove each directory tree in `paths`, ignoring any errors.
+
+    Args:
+        paths (List[str]): Directories to remove.
+    """
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _tombstones(out_dir: str) -> List[str]:
+    """
+    List the tombstones of `out_dir` left by overwriting it.
+
+    Only siblings in the exact generated form `<out_dir>.old.<pid>.<ns>` are
+    matched, so user directories such as `<out_dir>.old.backup` are never touched.
+
+    Args:
+        out_dir (str): Absolute path of the output directory.
+
+    Returns:
+        List[str]: Paths of the tombstone directories.
+    """
+    pattern = re.compile(rf"{re.escape(out_dir)}\.old\.\d+\.\d+")
+    return [
+        path for path in glob(f"{escape(out_dir)}.old.*") if pattern.fullmatch(path)
+    ]
+
+
 class Rescreener:
     """
     A class for performing CRISPR screen analysis on full and subset data.
@@ -52,6 +98,7 @@ class Rescreener:
         """
         self.table_path = table_path
         self._columns = self._fetch_columns()
+        self._col_index = {name: i for i, name in enumerate(self._columns)}
 
         self.reference_libraries = reference_libraries
         if test_libraries is not None:
@@ -72,6 +119,15 @@ class Rescreener:
         self._validate_aggregation_method()
         self._initialize_output_dir()
 
+        # Arguments shared by every `crispr_screen` invocation
+        self._cs_prefix = Rescreener._crispr_screen_prefix(
+            self.table_path,
+            self.reference_libraries,
+            aggregation_method=self.aggregation_method,
+            use_product=self.use_product,
+            min_base_mean=self.min_base_mean,
+        )
+
     def _fetch_columns(self):
         """
         Fetch and validate the columns from the input count matrix.
@@ -82,8 +138,10 @@ class Rescreener:
         Raises:
             ValueError: If the input file does not have the expected column structure.
         """
-        # Only load in a little of the matrix to match headers
-        columns = pd.read_csv(self.table_path, nrows=5, sep="\t").columns.to_list()
+        # Only read the header line of the matrix to match headers
+        opener = gzip.open if self.table_path.endswith(".gz") else open
+        with opener(self.table_path, "rt") as handle:
+            columns = handle.readline().rstrip("\r\n").split("\t")
 
         if columns[:2] != ["Guide", "Gene"]:
             raise ValueError(
@@ -107,9 +165,8 @@ class Rescreener:
             ValueError: If no treatment libraries are found after exclusions.
         """
         exclusion = set(exclude_samples) if exclude_samples is not None else set()
-        [exclusion.add(n) for n in self.reference_libraries]
-        [exclusion.add(n) for n in ["Guide", "Gene"]]
-        inclusion = [n for n in self._columns if n not in exclusion]
+        exclusion.update(self.reference_libraries)
+        inclusion = [n for n in self._columns[2:] if n not in exclusion]
         if len(inclusion) == 0:
             raise ValueError(
                 "No treatment libraries found - either they were all excluded for being in the reference library or too many exclusions were provided"
@@ -123,14 +180,15 @@ class Rescreener:
         Raises:
             ValueError: If any reference or test sample is missing from the input file.
         """
+        # Sample columns follow the `Guide` and `Gene` columns
         for name in self.reference_libraries:
-            if name not in self._columns[2:]:
+            if self._col_index.get(name, 0) < 2:
                 raise ValueError(
                     f"Reference sample `{name}` is missing from columns in provided matrix"
                 )
 
         for name in self.test_libraries:
-            if name not in self._columns[2:]:
+            if self._col_index.get(name, 0) < 2:
                 raise ValueError(
                     f"Treatment sample `{name}` is missing from columns in provided matrix"
                 )
@@ -142,7 +200,9 @@ class Rescreener:
         Raises:
             RuntimeError: If `crispr_screen` is not found in the PATH.
         """
-        if shutil.which("crispr_screen") is None:
+        if _resolve_crispr_screen() is None:
+            # Don't cache the miss, so installing it later in the session works
+            _resolve_crispr_screen.cache_clear()
             raise RuntimeError(
                 "Unable to find `crispr_screen` in `$PATH` - you will need to install it. Refer to https://noamteyssier.github.io/crispr_screen/install.html for details."
             )
@@ -178,12 +238,21 @@ class Rescreener:
         self._out_dir = os.path.abspath(self.prefix)
         self._full_dir = os.path.join(self._out_dir, FULL_DIR)
         self._subset_dir = os.path.join(self._out_dir, SUBSET_DIR)
+        self._subset_prefix = os.path.join(self._subset_dir, SUBSET_NAME_PREFIX)
 
         # Check if the directory exists
         if os.path.exists(self._out_dir):
             if self.overwrite:
-                # Remove the existing directory and its contents
-                shutil.rmtree(self._out_dir)
+                # Move the existing directory aside (O(1)) and remove its contents
+                # in the background so bootstraps can start immediately. The
+                # thread is not a daemon so the interpreter waits for it at exit,
+                # and it also sweeps tombstones left behind by interrupted runs.
+                tombstone = f"{self._out_dir}.old.{os.getpid()}.{time.time_ns()}"
+                os.rename(self._out_dir, tombstone)
+                threading.Thread(
+                    target=_remove_trees,
+                    args=(_tombstones(self._out_dir),),
+                ).start()
             else:
                 raise FileExistsError(
                     f"The directory {self._out_dir} already exists. Use overwrite=True to replace it."
@@ -199,7 +268,7 @@ class Rescreener:
 
         This method executes the `crispr_screen` command on the complete dataset.
         """
-        print("Starting crispr_screen...")
+        tqdm.write("Starting crispr_screen...")
         Rescreener._run_crispr_screen(
             self.table_path,
             os.path.join(self._full_dir, FULL_NAME_PREFIX),
@@ -209,7 +278,7 @@ class Rescreener:
             use_product=self.use_product,
             min_base_mean=self.min_base_mean,
         )
-        print("Done.")
+        tqdm.write("Done.")
 
     def run_bootstraps(
         self,
@@ -228,40 +297,91 @@ class Rescreener:
             num_reps (int, optional): Number of repetitions for each subset size. Defaults to 50.
             seed (int, optional): Random seed for reproducibility. Defaults to 42.
         """
-        np.random.seed(seed)
+        rng = np.random.default_rng(seed)
+        columns = np.asarray(self._columns)
+        test_idx = np.fromiter(
+            (self._col_index[n] for n in self.test_libraries), dtype=np.int32
+        )
+        num_tests = test_idx.size
+        subset_sizes = range(1, len(self.test_libraries), step_value)
+        max_size = max(subset_sizes, default=0)
+
+        # Draw every replicate of every size at once: (num_sizes, num_reps, max_size).
+        # Smaller sizes take a prefix of each row - a prefix of a random permutation is
+        # itself a sample without replacement.
+        shape = (len(subset_sizes), num_reps)
+        if self.with_replacement:
+            draws = rng.integers(0, num_tests, size=(*shape, max_size))
+        else:
+            draws = np.argsort(rng.random((*shape, num_tests)), axis=-1)[..., :max_size]
+        subsets = columns[test_idx[draws]]
 
-        # Prepare arguments for parallel execution
+        # Prepare arguments for parallel execution - identical draws (same multiset of
+        # samples) are only run once and copied to the other replicates afterwards
         args_list = []
-        for subset_size in np.arange(1, len(self.test_libraries), step_value):
+        duplicates = []
+        seen = {}
+        for size_index, subset_size in enumerate(subset_sizes):
             for rep_index in range(num_reps):
-                treatment_subset = np.random.choice(
-                    self.test_libraries, subset_size, replace=self.with_replacement
-                ).tolist()
-                name = f"{SUBSET_NAME_PREFIX}_{subset_size}_{rep_index}"
-                args_list.append((name, treatment_subset))
-
-        # Use multiprocessing to run the analyses in parallel
-        total_threads = self.n_threads if self.n_threads > 0 else None
-        with multiprocessing.Pool(processes=total_threads) as pool:
-            list(
-                tqdm(
-                    pool.imap(self._run_single_bootstrap, args_list),
-                    total=len(args_list),
-                    desc="Running bootstraps",
-                )
-            )
+                output_prefix = f"{self._subset_prefix}_{subset_size}_{rep_index}"
+                treatment_subset = subsets[size_index, rep_index, :subset_size]
+                key = tuple(sorted(treatment_subset.tolist()))
+                if key in seen:
+                    duplicates.append((seen[key], output_prefix, treatment_subset))
+                    continue
+                seen[key] = output_prefix
+                args_list.append((output_prefix, treatment_subset))
+
+        # Each worker only waits on a `crispr_screen` child, so threads suffice
+        total_threads = self.n_threads if self.n_threads > 0 else os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=total_threads) as executor:
+            futures = [
+                executor.submit(self._run_single_bootstrap, args) for args in args_list
+            ]
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc="Running bootstraps",
+                miniters=max(1, len(futures) // 100),
+            ):
+                future.result()
+
+            # Duplicates whose source run produced no outputs are run on their own
+            fallback = [
+                executor.submit(self._run_single_bootstrap, (output_prefix, subset))
+                for source_prefix, output_prefix, subset in duplicates
+                if not Rescreener._copy_outputs(source_prefix, output_prefix)
+            ]
+            for future in fallback:
+                future.result()
+
+    @staticmethod
+    def _copy_outputs(source_prefix: str, output_prefix: str) -> bool:
+        """
+        Copy every output file of a finished run to a new output prefix.
+
+        Any existing outputs under the new prefix (e.g. from a previous call) are
+        removed first. Files are copied rather than linked so that rerunning the
+        source never changes the copies.
+
+        Args:
+            source_prefix (str): Output prefix of the completed `crispr_screen` run.
+            output_prefix (str): Output prefix to expose the same results under.
+
+        Returns:
+            bool: Whether the source run produced any outputs to copy.
+        """
+        for path in glob(f"{escape(output_prefix)}.*"):
+            os.unlink(path)
+
+        sources = glob(f"{escape(source_prefix)}.*")
+        for path in sources:
+            shutil.copyfile(path, output_prefix + path[len(source_prefix) :])
+        return len(sources) > 0
 
     def _run_single_bootstrap(self, args):
-        name, treatment_subset = args
-        Rescreener._run_crispr_screen(
-            self.table_path,
-            os.path.join(self._subset_dir, name),
-            self.reference_libraries,
-            treatment_subset,
-            aggregation_method=self.aggregation_method,
-            use_product=self.use_product,
-            min_base_mean=self.min_base_mean,
-        )
+        output_prefix, treatment_subset = args
+        Rescreener._exec_crispr_screen(self._cs_prefix, output_prefix, treatment_subset)
 
     @staticmethod
     def _run_crispr_screen(
@@ -272,6 +392,7 @@ class Rescreener:
         aggregation_method: str = "geopagg",
         use_product: bool = False,
         min_base_mean: Optional[int] = None,
+        capture_output: bool = False,
     ) -> Tuple[bytes, bytes]:
         """
         Execute the CRISPR screen analysis command.
@@ -284,21 +405,47 @@ class Rescreener:
             output_prefix (str): Prefix for output files.
             reference_libraries (List[str]): List of reference library names.
             test_libraries (List[str]): List of test library names.
+            capture_output (bool, optional): Whether to capture stdout and stderr. Defaults to False.
 
         Returns:
-            Tuple[bytes, bytes]: Stdout and stderr output from the command execution.
+            Tuple[bytes, bytes]: Stdout and stderr output from the command execution (empty unless captured).
+        """
+        prefix = Rescreener._crispr_screen_prefix(
+            table_path,
+            reference_libraries,
+            aggregation_method=aggregation_method,
+            use_product=use_product,
+            min_base_mean=min_base_mean,
+        )
+        return Rescreener._exec_crispr_screen(
+            prefix, output_prefix, test_libraries, capture_output=capture_output
+        )
+
+    @staticmethod
+    def _crispr_screen_prefix(
+        table_path: str,
+        reference_libraries: List[str],
+        aggregation_method: str = "geopagg",
+        use_product: bool = False,
+        min_base_mean: Optional[int] = None,
+    ) -> Tuple[str, ...]:
+        """
+        Build the `crispr_screen` arguments that do not depend on the test libraries.
+
+        Args:
+            table_path (str): Path to the input count matrix file.
+            reference_libraries (List[str]): List of reference library names.
+
+        Returns:
+            Tuple[str, ...]: Command prefix to extend with the output prefix and test libraries.
         """
         args = []
-        args.append("crispr_screen")
+        args.append(_resolve_crispr_screen() or "crispr_screen")
         args.append("test")
         args.append("-i")
         args.append(table_path)
-        args.append("-o")
-        args.append(output_prefix)
         args.append("-c")
         args.extend(reference_libraries)
-        args.append("-t")
-        args.extend(test_libraries)
         args.append("-g")
         args.append(aggregation_method)
         args.append("-T")
@@ -308,8 +455,36 @@ class Rescreener:
         if min_base_mean is not None:
             args.append("--min-base-mean")
             args.append(str(min_base_mean))
+        return tuple(args)
 
-        cmd = Popen(args, stdout=PIPE, stderr=PIPE)
+    @staticmethod
+    def _exec_crispr_screen(
+        prefix: Tuple[str, ...],
+        output_prefix: str,
+        test_libraries: Sequence[str],
+        capture_output: bool = False,
+    ) -> Tuple[bytes, bytes]:
+        """
+        Run `crispr_screen` from a prebuilt command prefix.
+
+        Args:
+            prefix (Tuple[str, ...]): Command prefix from `_crispr_screen_prefix`.
+            output_prefix (str): Prefix for output files.
+            test_libraries (Sequence[str]): Test library names (a list or string array).
+            capture_output (bool, optional): Whether to capture stdout and stderr. Defaults to False.
+
+        Returns:
+            Tuple[bytes, bytes]: Stdout and stderr output from the command execution (empty unless captured).
+        """
+        args = (*prefix, "-o", output_prefix, "-t", *test_libraries)
+
+        # All our descriptors are non-inheritable (PEP 446), so skip the per-spawn fd
+        # sweep - with an absolute executable this lets CPython use posix_spawn
+        if not capture_output:
+            Popen(args, stdout=DEVNULL, stderr=DEVNULL, close_fds=False).wait()
+            return (b"", b"")
+
+        cmd = Popen(args, stdout=PIPE, stderr=PIPE, close_fds=False)
         stdout, stderr = cmd.communicate()
         return (stdout, stderr)
 
@@ -325,7 +500,7 @@ class Rescreener:
             Tuple[bytes, bytes]: Stdout and stderr output from the command execution.
         """
         args = []
-        args.append("crispr_screen")
+        args.append(_resolve_crispr_screen() or "crispr_screen")
         args.append("--version")
 
         cmd = Popen(args, stdout=PIPE, stderr=PIPE)